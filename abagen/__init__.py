@@ -15,13 +15,50 @@ del get_versions
 
 from .info import long_description as __doc__
 
-from . import io, mouse
-from .allen import (get_expression_data, get_samples_in_mask,
-                    get_interpolated_map)
-from .correct import keep_stable_genes, normalize_expression, remove_distance
-from .datasets import (fetch_desikan_killiany, fetch_gene_group,
-                       fetch_microarray, fetch_raw_mri, fetch_rnaseq,
-                       fetch_freesurfer, fetch_donor_info)
-from .images import leftify_atlas, relabel_gifti, annot_to_gifti, check_atlas
-from .matching import AtlasTree
-from .reporting import Report
+# public API is imported lazily (PEP 562) so that `import abagen` (and, by
+# extension, the command-line interface) doesn't pull in the full scientific
+# stack until it is actually needed. submodules (e.g., `abagen.images`) are
+# also imported on first access
+_LAZY_ATTRIBUTES = {
+    'get_expression_data': 'allen',
+    'get_samples_in_mask': 'allen',
+    'get_interpolated_map': 'allen',
+    'keep_stable_genes': 'correct',
+    'normalize_expression': 'correct',
+    'remove_distance': 'correct',
+    'fetch_desikan_killiany': 'datasets',
+    'fetch_gene_group': 'datasets',
+    'fetch_microarray': 'datasets',
+    'fetch_raw_mri': 'datasets',
+    'fetch_rnaseq': 'datasets',
+    'fetch_freesurfer': 'datasets',
+    'fetch_donor_info': 'datasets',
+    'leftify_atlas': 'images',
+    'relabel_gifti': 'images',
+    'annot_to_gifti': 'images',
+    'check_atlas': 'images',
+    'AtlasTree': 'matching',
+    'Report': 'reporting',
+}
+
+
+def __getattr__(name):
+    from importlib import import_module
+
+    try:
+        module = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        try:
+            return import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as err:
+            if err.name != f'{__name__}.{name}':  # missing dependency
+                raise
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    attr = getattr(import_module(f'.{module}', __name__), name)
+    globals()[name] = attr
+
+    return attr
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled kernels for :mod:`abagen.correct`
+
+Requires `numba`, which is an optional dependency; callers should be prepared
+to handle an ImportError when importing from this module.
+"""
+
+import numpy as np
+from numba import njit, prange
+
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def pairwise_corr(data, valid):
+    """
+    Correlates genes across regions for all pairs of donors in `data`
+
+    Parameters
+    ----------
+    data : (D, G, R) numpy.ndarray
+        Expression data of `G` genes across `R` regions for `D` donors
+    valid : (D, R) numpy.ndarray
+        Boolean array indicating which regions have data for each donor. Only
+        regions that are valid for both donors in a pair are correlated
+
+    Returns
+    -------
+    corrs : (G, D * (D - 1) / 2) numpy.ndarray
+        Correlation of each gene for every pair of donors, where pairs are
+        ordered as in `itertools.combinations(range(D), 2)`
+    """
+
+    n_subj, n_gene, n_reg = data.shape
+    n_pair = n_subj * (n_subj - 1) // 2
+    first, second = np.empty(n_pair, np.int64), np.empty(n_pair, np.int64)
+    shared = np.empty((n_pair, n_reg), np.bool_)
+    pair = 0
+    for s1 in range(n_subj):
+        for s2 in range(s1 + 1, n_subj):
+            first[pair], second[pair] = s1, s2
+            shared[pair] = valid[s1] & valid[s2]
+            pair += 1
+
+    corrs = np.empty((n_gene, n_pair))
+    for gene in prange(n_gene):
+        for pair in range(n_pair):
+            x, y = data[first[pair], gene], data[second[pair], gene]
+            both = shared[pair]
+            num, xmean, ymean = 0, 0.0, 0.0
+            for reg in range(n_reg):
+                if both[reg]:
+                    num += 1
+                    xmean += x[reg]
+                    ymean += y[reg]
+            if num < 2:
+                corrs[gene, pair] = np.nan
+                continue
+            xmean, ymean = xmean / num, ymean / num
+            sxx, syy, sxy = 0.0, 0.0, 0.0
+            for reg in range(n_reg):
+                if both[reg]:
+                    xdev, ydev = x[reg] - xmean, y[reg] - ymean
+                    sxx += xdev * xdev
+                    syy += ydev * ydev
+                    sxy += xdev * ydev
+            corrs[gene, pair] = sxy / np.sqrt(sxx * syy)
+
+    return corrs
+
+
+@njit(cache=True, error_model='numpy')
+def resid_dist(dv, iv, groups, n_groups):
+    """
+    Calculates residuals of `dv` after controlling for `iv` within `groups`
+
+    Parameters
+    ----------
+    dv, iv : (N,) numpy.ndarray
+        Dependent and independent variables
+    groups : (N,) numpy.ndarray
+        Integer group assignments (in ``[0, n_groups)``) of entries in `dv`
+    n_groups : int
+        Number of groups
+
+    Returns
+    -------
+    residuals : (N,) numpy.ndarray
+        Residuals of `dv` after controlling for `iv`
+    """
+
+    counts = np.zeros(n_groups)
+    dmean, imean = np.zeros(n_groups), np.zeros(n_groups)
+    for n in range(len(dv)):
+        grp = groups[n]
+        counts[grp] += 1
+        dmean[grp] += dv[n]
+        imean[grp] += iv[n]
+    dmean, imean = dmean / counts, imean / counts
+
+    sxx, sxy = np.zeros(n_groups), np.zeros(n_groups)
+    for n in range(len(dv)):
+        grp = groups[n]
+        idev = iv[n] - imean[grp]
+        sxx[grp] += idev * idev
+        sxy[grp] += idev * (dv[n] - dmean[grp])
+    slope = np.zeros(n_groups)
+    for grp in range(n_groups):
+        if sxx[grp] > 0:
+            slope[grp] = sxy[grp] / sxx[grp]
+
+    residuals = np.empty(len(dv))
+    for n in range(len(dv)):
+        grp = groups[n]
+        residuals[n] = ((dv[n] - dmean[grp])
+                        - slope[grp] * (iv[n] - imean[grp]))
+
+    return residuals
@@ -716,7 +716,8 @@ def get_interpolated_map(genes, mask, n_neighbors=10, **kwargs):
     # TODO: constrain by hemisphere (and structure?)
     exptree = matching.AtlasTree(np.asarray(expression.index),
                                  coords=np.asarray(coords))
-    dist, idx = exptree.tree.query(mask.coords, k=n_neighbors)
+    dist, idx = exptree.tree.query(mask.coords, k=n_neighbors,
+                                   workers=exptree.workers)
     dist = _get_weights(dist)
 
     # get average of nearest neighbors
@@ -2,6 +2,7 @@
 
 import argparse
 import logging
+import multiprocessing as mp
 import os
 from pathlib import Path
 from typing import Iterable
@@ -9,6 +10,21 @@ import sys
 
 LGR = logging.getLogger('abagen')
 
+# method names accepted by `--probe-selection` and `--sample/gene-norm`. these
+# mirror the keys of `abagen.probes_.SELECTION_METHODS` and
+# `abagen.correct.NORMALIZATION_METHODS`, but are hard-coded so that building
+# the parser (e.g., for `--help`) doesn't import the scientific stack
+SELECTION_METHODS = (
+    'mean', 'average', 'max_intensity', 'max_variance', 'pc_loading',
+    'corr_variance', 'corr_intensity', 'diff_stability', 'rnaseq'
+)
+NORMALIZATION_METHODS = (
+    'sig', 'scaled_sig', 'scaled_sig_qnt', 'mixed_sig', 'rs', 'srs', 'center',
+    'zscore', 'minmax', 'demean', 'rsig', 'robust_sigmoid', 'scaled_rsig',
+    'scaled_robust_sigmoid', 'sigmoid', 'scaled_sigmoid',
+    'scaled_sigmoid_quantiles', 'mixed_sigmoid'
+)
+
 
 def isiterable(val):
     """ Helper function to check whether value is iterable (but not string)
@@ -29,6 +45,17 @@ def _resolve_path(path):
             return os.path.abspath(os.path.expanduser(path))
 
 
+def _resolve_output(path):
+    """ Helper function for get_parser() to make output paths absolute
+
+    Unlike _resolve_path() this does not touch the filesystem (i.e., it does
+    not resolve symlinks), since output paths need not exist yet
+    """
+
+    if path is not None:
+        return os.path.abspath(os.path.expanduser(path))
+
+
 def _resolve_none(inp):
     """ Helper function to allow 'None' as input from argparse
     """
@@ -61,8 +88,6 @@ def get_parser():
     """
 
     from .. import __version__
-    from ..correct import NORMALIZATION_METHODS
-    from ..probes_ import SELECTION_METHODS
 
     verstr = 'abagen {}'.format(__version__)
     parser = argparse.ArgumentParser(
@@ -174,8 +199,10 @@ across donors via the supplied `--region_agg` and `--agg_metric` parameters.
     g_data.add_argument('--n_proc', '--n-proc', action='store', type=int,
                         default=1,
                         help='Number of processors to use to download AHBA '
-                             'data. Can paralellize up to six times if all '
-                             'donors are requested. Default: 1')
+                             'data and to save donor-level expression data '
+                             '(if `--save-donors` is set). Can paralellize up '
+                             'to six times if all donors are requested. '
+                             'Default: 1')
 
     w_data = parser.add_argument_group('Options to specify processing options')
     w_data.add_argument('--ibf_threshold', '--ibf-threshold', action='store',
@@ -325,7 +352,7 @@ across donors via the supplied `--region_agg` and `--agg_metric` parameters.
                              'and `--save-donors` (i.e., this will override '
                              'those options). Default: False')
     o_data.add_argument('--output-file', '--output_file', action='store',
-                        type=_resolve_path, metavar='PATH',
+                        type=_resolve_output, metavar='PATH',
                         default='abagen_expression.csv',
                         help='Path to desired output file. The generated '
                              'region x gene dataframe will be saved here. '
@@ -348,11 +375,43 @@ across donors via the supplied `--region_agg` and `--agg_metric` parameters.
     return parser
 
 
+def _save_donors(expression, output_path, fname_pref, n_proc=1):
+    """ Helper function for main() to save donor-level expression dataframes
+
+    Returns dictionary mapping donor IDs to the filenames they were saved to
+    """
+
+    # save each donor dataframe as a separate file; writing CSVs is slow
+    # and GIL-bound so use processes (not threads) when possible
+    fnames = {}
+    for donor in expression:
+        fnames[donor] = os.path.join(output_path,
+                                     fname_pref + '_{}.csv'.format(donor))
+        LGR.info('Saving donor {} info to {}'.format(donor, fnames[donor]))
+    if n_proc < 0:
+        n_proc = mp.cpu_count() + n_proc + 1
+    if min(n_proc, len(fnames)) > 1:
+        with mp.Pool(min(n_proc, len(fnames))) as pool:
+            results = [pool.apply_async(expression[donor].to_csv, (fn,))
+                       for donor, fn in fnames.items()]
+            for res in results:
+                res.get()
+    else:
+        for donor, fn in fnames.items():
+            expression[donor].to_csv(fn)
+
+    return fnames
+
+
 def main(args=None):
     """ Runs primary get_expression_data workflow
     """
 
-    from ..allen import get_expression_data
+    # no need to build the full parser just to print the version
+    if '--version' in (sys.argv[1:] if args is None else args):
+        from .. import __version__
+        print('abagen {}'.format(__version__))
+        sys.exit(0)
 
     opts = get_parser().parse_args(args)
 
@@ -361,6 +420,8 @@ def main(args=None):
         print(opts)
         return
 
+    from ..allen import get_expression_data
+
     # run the workflow
     expression = get_expression_data(atlas=opts.atlas,
                                      atlas_info=opts.atlas_info,
@@ -402,12 +463,7 @@ def main(args=None):
 
     # determine how best to save expression output files
     if opts.save_donors:
-        # save each donor dataframe as a separate file
-        for donor, exp in expression.items():
-            exp_fname = os.path.join(output_path,
-                                     fname_pref + '_{}.csv'.format(donor))
-            LGR.info('Saving donor {} info to {}'.format(donor, exp_fname))
-            exp.to_csv(exp_fname)
+        _save_donors(expression, output_path, fname_pref, opts.n_proc)
     else:
         expression.to_csv(opts.output_file)
 
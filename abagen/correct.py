@@ -9,10 +9,10 @@ import warnings
 
 import numpy as np
 import pandas as pd
+from scipy.spatial.distance import squareform
 import scipy.stats as sstats
-from scipy.spatial.distance import cdist
 
-from . import images, utils
+from . import utils
 
 
 def _unpack_tuple(var):
@@ -449,9 +449,11 @@ def remove_distance(coexpression, atlas, atlas_info=None, labels=None):
     coexpression : (R x R) array_like
         Correlated gene expression array, where `R` is the number of regions,
         as generated with e.g., `numpy.corrcoef(expression)`.
-    atlas : niimg-like object
+    atlas : niimg-like object or :obj:`abagen.AtlasTree`
         A parcellation image in MNI space, where each parcel is identified by a
-        unique integer ID
+        unique integer ID. If calling this function repeatedly with the same
+        atlas, providing an AtlasTree (e.g., from `abagen.check_atlas()`) will
+        avoid re-computing parcel centroids and distances on every call
     atlas_info : str or pandas.DataFrame, optional
         Filepath to or pre-loaded dataframe containing information about
         `atlas`. Must have at least columns 'id', 'hemisphere', and 'structure'
@@ -471,7 +473,12 @@ def remove_distance(coexpression, atlas, atlas_info=None, labels=None):
         between region pairs
     """
 
-    atlas = images.check_atlas(atlas)
+    # imported here so that `abagen.correct` doesn't need to pull in all of the
+    # image / dataset handling machinery until it's actually needed
+    from .images import check_atlas, check_atlas_info
+
+    atlas = check_atlas(atlas)
+    coexpression = np.asarray(coexpression, dtype=float)
 
     # check atlas + coexpression make sense
     if labels is None:
@@ -484,7 +491,7 @@ def remove_distance(coexpression, atlas, atlas_info=None, labels=None):
 
     # load atlas_info, if provided
     if atlas_info is not None:
-        atlas_info = images.check_atlas_info(atlas_info, labels)
+        atlas_info = check_atlas_info(atlas_info, labels)
 
     # check that provided coexpression array is symmetric
     if not np.allclose(coexpression, coexpression.T, atol=1e-10):
@@ -492,44 +499,47 @@ def remove_distance(coexpression, atlas, atlas_info=None, labels=None):
 
     # we'll do basic Euclidean distance correction for now
     # TODO: implement gray matter volume / cortical surface path distance
+    # (condensed distances are in the same order as `np.triu_indices`)
     if labels is None:
         labels = atlas.labels
-    centroids = np.row_stack([atlas.centroids[lab] for lab in labels])
-    dist = cdist(centroids, centroids, metric='euclidean')
+    dist = atlas._get_centroid_dist(labels)
 
-    corr_resid = np.zeros_like(coexpression)
-    triu_inds = np.triu_indices_from(coexpression, k=1)
+    # residuals are stored in condensed (upper triangle) form, matching `dist`
+    rows, cols = np.triu_indices_from(coexpression, k=1)
     # if no atlas_info, just residualize all correlations against distance
     if atlas_info is None:
-        corr_resid[triu_inds] = _resid_dist(coexpression[triu_inds],
-                                            dist[triu_inds])
+        resid = _resid_dist(coexpression[rows, cols], dist)
     # otherwise, we can residualize the different connection types separately
     else:
-        triu_inds = np.ravel_multi_index(triu_inds, corr_resid.shape)
-        coexpression, dist = coexpression.ravel(), dist.ravel()
-        types = ['cortex', 'subcortex']
-        for src, tar in itertools.combinations_with_replacement(types, 2):
-            # get indices of sources and targets
-            sources = np.where(atlas_info.structure == src)[0]
-            targets = np.where(atlas_info.structure == tar)[0]
-            inds = np.ravel_multi_index(np.ix_(sources, targets),
-                                        corr_resid.shape)
-            if src != tar:  # e.g., cortex + subcortex
-                rev = np.ravel_multi_index(np.ix_(targets, sources),
-                                           corr_resid.shape)
-                inds = np.append(inds.ravel(), rev.ravel())
-            # find intersection of source / target indices + upper triangle
-            inds = np.intersect1d(triu_inds, inds)
-            back = np.unravel_index(inds, corr_resid.shape)
-            # residualize
-            corr_resid[back] = _resid_dist(coexpression[inds], dist[inds])
-
-    corr_resid = (corr_resid + corr_resid.T + np.eye(len(corr_resid)))
+        struct = np.asarray(atlas_info.loc[labels, 'structure'])
+        types = {t: struct == t for t in ['cortex', 'subcortex']}
+        groups = np.full(len(rows), -1)
+        for n, (src, tar) in enumerate(
+                itertools.combinations_with_replacement(types, 2)):
+            # find region pairs connecting sources + targets (either way)
+            sources, targets = types[src], types[tar]
+            block = np.logical_or(sources[rows] & targets[cols],
+                                  targets[rows] & sources[cols])
+            groups[block] = n
+        # residualize all connection types in one go
+        keep = groups >= 0
+        resid = np.zeros(len(rows))
+        resid[keep] = _resid_dist(coexpression[rows[keep], cols[keep]],
+                                  dist[keep], groups=groups[keep])
+
+    # only materialize the full (symmetric) matrix once, at the very end
+    corr_resid = squareform(resid, checks=False)
+    np.fill_diagonal(corr_resid, 1)
 
     return corr_resid
 
 
-def _resid_dist(dv, iv):
+# number of entries above which the compiled `_resid_dist` kernel pays for its
+# compilation; for typical parcellations (R < 1000) numpy is just as fast
+_RESID_NUMBA_MIN = 2_000_000
+
+
+def _resid_dist(dv, iv, groups=None):
     """
     Calculates residuals of `dv` after controlling for `iv`
 
@@ -539,18 +549,100 @@ def _resid_dist(dv, iv):
         Dependent variable
     iv : array_like
         Independent variable; removed from `dv`
+    groups : array_like, optional
+        Non-negative integer group assignments of entries in `dv` and `iv`. If
+        provided, `iv` is removed from `dv` separately for each group.
+        Default: None
 
     Returns
     -------
     residuals : array_like
         Residuals of `dv` after controlling for `iv`
     """
-    dv = dv.squeeze()
-    distance = np.column_stack((iv, np.ones_like(iv)))
-    betas, *rest = np.linalg.lstsq(distance, dv, rcond=None)
-    residuals = dv - (distance @ betas)
 
-    return residuals.squeeze()
+    dv = np.asarray(dv, dtype=float).ravel()
+    iv = np.asarray(iv, dtype=float).ravel()
+    if groups is None:
+        groups = np.zeros(len(dv), dtype=int)
+    groups = np.asarray(groups).ravel()
+
+    # use compiled kernel (single pass per moment) for very large inputs
+    if len(dv) >= _RESID_NUMBA_MIN:
+        try:
+            return _resid_dist_numba(dv, iv, groups)
+        except ImportError:  # no numba, so use closed-form numpy solution
+            pass
+
+    # closed-form solution for slope + intercept (no need for lstsq / SVD)
+    counts = np.bincount(groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dv_c = dv - (np.bincount(groups, weights=dv) / counts)[groups]
+        iv_c = iv - (np.bincount(groups, weights=iv) / counts)[groups]
+    sxx = np.bincount(groups, weights=iv_c * iv_c)
+    sxy = np.bincount(groups, weights=iv_c * dv_c)
+    slope = np.divide(sxy, sxx, out=np.zeros_like(sxy), where=sxx > 0)
+    residuals = dv_c - (slope[groups] * iv_c)
+
+    return residuals
+
+
+def _resid_dist_numba(dv, iv, groups):
+    """
+    Compiled equivalent of :func:`_resid_dist`
+
+    Requires `numba`; raises ImportError if it is not installed
+
+    Parameters
+    ----------
+    dv, iv : (N,) numpy.ndarray
+        Dependent and independent variables
+    groups : (N,) numpy.ndarray
+        Non-negative integer group assignments of entries in `dv` and `iv`
+
+    Returns
+    -------
+    residuals : (N,) numpy.ndarray
+        Residuals of `dv` after controlling for `iv`
+    """
+
+    from ._correct_numba import resid_dist
+
+    n_groups = groups.max() + 1 if len(groups) > 0 else 0
+    return resid_dist(dv, iv, groups.astype(np.int64), n_groups)
+
+
+def _pairwise_corr(data, regions):
+    """
+    Correlates genes across shared regions for all pairs of donors
+
+    Requires `numba`; raises ImportError if it is not installed
+
+    Parameters
+    ----------
+    data : list of (R, G) numpy.ndarray
+        Where each entry is the expression of `R` regions across `G` genes
+        for a given donor. `R` may differ between donors
+    regions : list of (R,) numpy.ndarray
+        Region labels for the rows of each entry in `data`
+
+    Returns
+    -------
+    gene_corrs : (G, P) numpy.ndarray
+        Correlation of each gene across shared regions for all `P` pairs of
+        donors, ordered as in `itertools.combinations`
+    """
+
+    from ._correct_numba import pairwise_corr
+
+    # align donors to the union of their regions (genes x regions in memory)
+    union = np.unique(np.concatenate(regions))
+    stacked = np.full((len(data), data[0].shape[-1], len(union)), np.nan)
+    valid = np.zeros((len(data), len(union)), dtype=bool)
+    for n, (arr, reg) in enumerate(zip(data, regions)):
+        idx = np.searchsorted(union, reg)
+        stacked[n][:, idx], valid[n, idx] = arr.T, True
+
+    return pairwise_corr(stacked, valid)
 
 
 def keep_stable_genes(expression, threshold=0.9, percentile=True, rank=True,
@@ -597,16 +689,42 @@ def keep_stable_genes(expression, threshold=0.9, percentile=True, rank=True,
     num_subj = len(expression)
     num_gene = expression[0].shape[-1]
 
-    # rank data, if necessary
-    for_corr = expression if not rank else [e.rank() for e in expression]
+    # rank data, if necessary, and drop regions without data once per donor
+    # (rather than once per pair); ranking one donor at a time means we only
+    # hold a single ranked copy of the data in memory. everything downstream
+    # works on plain arrays (data + sorted region labels), so no pandas
+    # objects are created per donor pair
+    data, regions = [], []
+    for exp in expression:
+        if rank:
+            exp = exp.rank()
+        arr, index = np.asarray(exp, dtype=float), np.asarray(exp.index)
+        notna = np.logical_not(np.all(np.isnan(arr), axis=1))
+        order = np.argsort(index[notna], kind='stable')
+        data.append(arr[notna][order])
+        regions.append(index[notna][order])
 
     # get correlation of gene expression across regions for all donor pairs
-    gene_corrs = np.zeros((num_gene, sum(range(num_subj))))
-    for n, (s1, s2) in enumerate(itertools.combinations(range(num_subj), 2)):
-        regions = np.intersect1d(for_corr[s1].dropna(axis=0, how='all').index,
-                                 for_corr[s2].dropna(axis=0, how='all').index)
-        gene_corrs[:, n] = utils.efficient_corr(for_corr[s1].loc[regions],
-                                                for_corr[s2].loc[regions])
+    shared = all(np.array_equal(regions[0], reg) for reg in regions[1:])
+    if shared and len(regions[0]) > 1:
+        # all donors have the same regions so we can z-score each donor once
+        # and correlate every pair of donors in a single einsum
+        zscored = np.stack([sstats.zscore(arr, ddof=1) for arr in data])
+        corrs = np.einsum('drg,erg->deg', zscored, zscored)
+        gene_corrs = corrs[np.triu_indices(num_subj, k=1)].T
+        gene_corrs /= len(regions[0]) - 1
+    else:
+        try:
+            gene_corrs = _pairwise_corr(data, regions)
+        except ImportError:  # no numba, so loop through donor pairs
+            gene_corrs = np.zeros((num_gene, sum(range(num_subj))))
+            for n, (s1, s2) in enumerate(
+                    itertools.combinations(range(num_subj), 2)):
+                _, idx1, idx2 = np.intersect1d(regions[s1], regions[s2],
+                                               assume_unique=True,
+                                               return_indices=True)
+                gene_corrs[:, n] = utils.efficient_corr(data[s1][idx1],
+                                                        data[s2][idx2])
 
     # average similarity across donors (ignore NaNs)
     with warnings.catch_warnings():
@@ -8,9 +8,12 @@ import warnings
 import numpy as np
 import pandas as pd
 from scipy.spatial import cKDTree, distance_matrix
+from scipy.spatial.distance import pdist
 
 from . import io, transforms, surfaces
 
+HEMISPHERES = ['L', 'R', 'B']
+
 
 class AtlasTree:
     """
@@ -39,13 +42,17 @@ class AtlasTree:
         Whether the provided `atlas` is a group atlas (in MNI space) or a
         donor-level atlas (in native space). This will have an impact on how
         provided sample coordinates are handled. Default: True
+    workers : int, optional
+        Number of threads used to query the underlying cKDTree. If -1, all
+        available CPUs are used. Default: -1
     """
 
     def __init__(self, atlas, coords=None, *, triangles=None, atlas_info=None,
-                 group_atlas=True):
+                 group_atlas=True, workers=-1):
         from .images import check_img
 
         self._full_coords = self._graph = None
+        self.workers = workers
         try:  # let's first check if it's an image
             atlas = check_img(atlas)
             atlas, affine = np.asarray(atlas.dataobj), atlas.affine
@@ -59,8 +66,11 @@ class AtlasTree:
             vox = affine[:-1, :-1][np.where(affine[:-1, :-1])]  # TODO: oblique
             for vs, off, ndim in zip(vox, affine[:-1, -1], self._shape):
                 self._volumetric += (np.arange(off, off + (vs * ndim), vs),)
-            nz = atlas.nonzero()
-            atlas, coords = atlas[nz], transforms.ijk_to_xyz(np.c_[nz], affine)
+            # find non-zero voxels in a single pass over the (flattened) image
+            flat = np.flatnonzero(atlas)
+            nz = np.unravel_index(flat, self._shape)
+            atlas = atlas.ravel()[flat]
+            coords = transforms.ijk_to_xyz(np.column_stack(nz), affine)
         except TypeError:
             atlas = np.asarray(atlas)
             self._full_coords = coords
@@ -79,12 +89,21 @@ class AtlasTree:
         self._tree = cKDTree(coords)
         self._atlas = np.asarray(atlas)
         self._labels = np.unique(self.atlas).astype(int)
+        # index of each node's label in `self.labels` (for quick counting),
+        # stored w/smallest integer dtype that can hold all label indices
+        self._atlas_idx = np.searchsorted(self._labels, self._atlas).astype(
+            np.min_scalar_type(max(len(self._labels) - 1, 0))
+        )
         self._centroids = get_centroids(self.atlas, coords)
+        self._centroid_arr = np.r_[list(self._centroids.values())]
         # if not volumetric tree then centroid should be _on_ surface
         if self._volumetric is None:
-            centroids = np.r_[list(self._centroids.values())]
-            _, idx = self.tree.query(centroids, k=1)
+            _, idx = self.tree.query(self._centroid_arr, k=1,
+                                     workers=self.workers)
             self._centroids = dict(zip(self.labels, self.coords[idx]))
+            self._centroid_arr = self.coords[idx]
+        self._centroid_dist = None
+        self._atlas_info = None
         self.atlas_info = atlas_info
         self.triangles = triangles
         self.group_atlas = group_atlas
@@ -103,6 +122,18 @@ class AtlasTree:
         """
         return self._tree
 
+    @property
+    def workers(self):
+        """ Returns number of threads used to query `self.tree`
+        """
+        return self._workers
+
+    @workers.setter
+    def workers(self, workers):
+        """ Sets number of threads used to query `self.tree`
+        """
+        self._workers = int(workers)
+
     @property
     def atlas(self):
         """ Returns values of provided atlas
@@ -127,6 +158,38 @@ class AtlasTree:
         """
         return self._centroids
 
+    def _get_centroid_dist(self, labels):
+        """
+        Returns Euclidean distance between centroids of parcels `labels`
+
+        If `labels` are all the parcels in `self.atlas` (in order), distances
+        are computed on first use and cached (until `self.coords` are changed);
+        otherwise, they are computed only for the requested `labels`
+
+        Parameters
+        ----------
+        labels : (N,) array_like
+            Parcel labels in `self.atlas`
+
+        Returns
+        -------
+        dist : (N * (N - 1) / 2,) np.ndarray
+            Condensed distance matrix (see `scipy.spatial.distance.pdist`)
+            between centroids of `labels`. Entries are ordered as the upper
+            triangle of the full distance matrix (i.e., `np.triu_indices`)
+        """
+
+        lut = dict(zip(self.centroids, range(len(self.centroids))))
+        idx = np.asarray([lut[lab] for lab in labels], dtype=int)
+
+        # all parcels in original order, so we can use (or fill) the cache
+        if np.array_equal(idx, np.arange(len(self.centroids))):
+            if self._centroid_dist is None:
+                self._centroid_dist = pdist(self._centroid_arr)
+            return self._centroid_dist
+
+        return pdist(self._centroid_arr[idx])
+
     @property
     def graph(self):
         """ Returns graph of underlying parcellation
@@ -148,9 +211,17 @@ class AtlasTree:
             raise ValueError('Provided coordinates do not match length of '
                              'current atlas. Expected {}. Received {}'
                              .format(len(self.atlas), len(pts)))
-        if not np.allclose(pts, self.coords):
+        # exact comparison is cheap and short-circuits the common case where
+        # the tree is re-assigned its own coordinates
+        coords = self.coords
+        if pts.shape == coords.shape and pts.dtype == coords.dtype \
+                and np.array_equal(pts, coords):
+            return
+        if not np.allclose(pts, coords):
             self._tree = cKDTree(pts)
             self._centroids = get_centroids(self.atlas, pts)
+            self._centroid_arr = np.r_[list(self._centroids.values())]
+            self._centroid_dist = None
             # update graph with new coordinates (if relevant)
             self.triangles = self.triangles
 
@@ -190,11 +261,90 @@ class AtlasTree:
         """ Sets atlas info dataframe
         """
         from .images import check_atlas_info
+        # nothing to do if re-assigned the (already checked) current info
+        if info is self._atlas_info:
+            return
         if info is not None:
             self._atlas_info = check_atlas_info(info, self.labels)
+            # integer-coded hemisphere / structure of each label (in the same
+            # order as `self.labels`) for fast checking of samples (see
+            # `_check_codes()`)
+            self._structures = np.unique(self._atlas_info['structure'])
+            codes = self._encode_samples(self._atlas_info.loc[self.labels])
+            self._label_codes = np.empty(len(self.labels),
+                                         dtype=[('hemisphere', 'i1'),
+                                                ('structure', 'i1')])
+            self._label_codes['hemisphere'] = codes[0]
+            self._label_codes['structure'] = codes[1]
         else:
             self._atlas_info = info
 
+    def _encode_samples(self, sample_info):
+        """
+        Converts hemisphere + structure of `sample_info` to integer codes
+
+        Parameters
+        ----------
+        sample_info : pandas.DataFrame
+            Row(s) of an `annotation` file
+
+        Returns
+        -------
+        codes : tuple-of-np.ndarray or None
+            Codes for the hemisphere and structure of each sample, matching
+            the codes used for `self.atlas_info`. Unknown values are coded
+            -1. If `sample_info` does not have hemisphere or structure
+            information None is returned instead
+        """
+
+        try:
+            hemi, struct = sample_info['hemisphere'], sample_info['structure']
+        except KeyError:
+            return None
+
+        return (pd.Categorical(hemi, categories=HEMISPHERES).codes,
+                pd.Categorical(struct, categories=self._structures).codes)
+
+    def _check_codes(self, label, codes):
+        """
+        Checks that `label` is coherent with encoded sample info in `codes`
+
+        Works on integer codes (see `_encode_samples()`) rather than on the
+        dataframes themselves. Non-matching labels are re-assigned a value of 0
+
+        Parameters
+        ----------
+        label : array_like
+            Tentative label(s) for sample(s) described by `codes`
+        codes : tuple-of-array_like or None
+            Encoded hemisphere and structure of sample(s). Codes for a single
+            sample are broadcast against all `label`. If None, no checking is
+            performed
+
+        Returns
+        -------
+        label : np.ndarray
+            New label(s) for sample(s)
+        """
+
+        label = np.atleast_1d(label)
+        if codes is None:
+            return label
+
+        # labels that aren't in the atlas have no info and are always dropped
+        idx = np.searchsorted(self.labels, label)
+        known = idx < len(self.labels)
+        idx[~known] = 0
+        known &= self.labels[idx] == label
+        info = self._label_codes[idx]
+        hemi, struct = info['hemisphere'], info['structure']
+        # only compare structure for bilateral ROIs, but compare hemisphere +
+        # structure for L/R ROIs
+        drop = ~known | (struct != codes[1])
+        drop |= (hemi != HEMISPHERES.index('B')) & (hemi != codes[0])
+
+        return np.where(drop, 0, label)
+
     def label_samples(self, annotation, tolerance=2):
         """
         Matches all samples in `annotation` to parcels in `self.atlas`
@@ -286,21 +436,22 @@ class AtlasTree:
         the mean distance computed across all matched samples are unassigned.
         """
 
-        dist, idx = self.tree.query(samples[['mni_x', 'mni_y', 'mni_z']], k=1)
+        dist, idx = self.tree.query(samples[['mni_x', 'mni_y', 'mni_z']], k=1,
+                                    workers=self.workers)
         labels = self.atlas[idx]
 
         if self.atlas_info is not None:
-            labels = _check_label(labels, samples, self.atlas_info)
+            labels = self._check_codes(labels, self._encode_samples(samples))
 
         if tolerance < 0:
-            mask = dist > -tolerance
-        else:
-            if len(labels) > 1:
-                with np.errstate(invalid='ignore'):
-                    mask = dist > dist.mean() + (dist.std(ddof=1) * tolerance)
-            else:
-                mask = np.zeros(len(labels), dtype=bool)
-        labels[mask] = 0
+            labels[dist > -tolerance] = 0
+        elif len(labels) > 1:
+            # get mean + (sample) standard deviation of distances in one go,
+            # reusing the de-meaned distances for the sum of squares
+            with np.errstate(invalid='ignore'):
+                dev = dist - (dist.sum() / len(dist))
+                std = np.sqrt((dev @ dev) / (len(dist) - 1))
+                labels[dev > std * tolerance] = 0
 
         return labels
 
@@ -326,46 +477,137 @@ class AtlasTree:
         do not fall w/i a `tolerance` mm radius of any parcel are not assigned.
         """
 
-        cols = ['mni_x', 'mni_y', 'mni_z']
+        # extract coordinates (and hemisphere / structure) of samples once
+        xyz = samples[['mni_x', 'mni_y', 'mni_z']].to_numpy(dtype=float)
+        codes = None
+        if self.atlas_info is not None:
+            codes = self._encode_samples(samples)
+
         tol, labels = 0, np.zeros(len(samples))
-        idx = np.ones(len(samples), dtype=bool)
-        while tol <= tolerance and np.sum(idx) > 0:
-            subsamp = samples.loc[idx]
-            matches = self.tree.query_ball_point(subsamp[cols], tol)
-            labs = np.zeros(len(subsamp))
-            for n, match in enumerate(matches):
-                if len(match) > 0:
-                    labs[n] = self._assign_sample(self.atlas[match],
-                                                  subsamp.iloc[[n]])
-            labels[idx] = labs
-            idx = labels == 0
-            tol += 1
+        if len(samples) == 0 or tolerance < 0:
+            return labels
+
+        # most samples fall directly within a parcel, so first only look for
+        # nodes at the samples themselves. then find all nodes within
+        # `tolerance` of the remaining samples in one go, using their
+        # distances to emulate an expanding search radius (querying every
+        # sample at full `tolerance` would need O(S * tolerance^3) memory)
+        idx, n_left = np.ones(len(samples), dtype=bool), len(samples)
+        for radius in np.unique([0, np.floor(tolerance)]):
+            if n_left == 0:
+                break
+            left = np.flatnonzero(idx)
+            # samples are queried in z-order so that consecutive queries
+            # traverse neighboring parts of the tree, then put back in order
+            order = _morton_order(xyz[left], cell_size=max(radius, 1))
+            matches = np.empty(len(left), dtype=object)
+            matches[order] = self.tree.query_ball_point(xyz[left[order]],
+                                                        radius,
+                                                        workers=self.workers)
+            smp = np.repeat(left, [len(m) for m in matches])
+            nodes = np.concatenate(matches).astype(int)
+            sqdist = np.sum((self.coords[nodes] - xyz[smp]) ** 2, axis=1)
+
+            while tol <= radius and n_left > 0:
+                near = np.logical_and(sqdist <= tol ** 2, idx[smp])
+                labs = self._assign_samples(smp[near], nodes[near], xyz,
+                                            codes)[idx]
+                labels[idx] = labs
+                idx[idx] = labs == 0
+                n_left -= np.count_nonzero(labs)
+                tol += 1
 
         return labels
 
-    def _assign_sample(self, possible, sample):
+    def _assign_samples(self, smp, nodes, coords, codes=None):
         """
-        Determines which parcel `sample` belongs to amongst `possible` labels
+        Determines which parcel each sample belongs to
+
+        Vectorized version of :meth:`_assign_sample`; the latter is only called
+        for samples where two or more parcels are tied for the most nodes
+
+        Parameters
+        ----------
+        smp, nodes : (N,) np.ndarray
+            Pairs of sample indices (into `coords`) and indices of the nodes
+            in `self.atlas` that are near those samples, sorted by sample
+        coords : (S, 3) np.ndarray
+            XYZ coordinates of samples
+        codes : tuple-of-np.ndarray, optional
+            Encoded hemisphere + structure of samples (see `_encode_samples()`)
+            used to constrain matching if `self.atlas_info` is not None.
+            Default: None
+
+        Returns
+        -------
+        labels : (S,) np.ndarray
+            Chosen labels for all provided samples
+        """
+
+        labels = np.zeros(len(coords))
+        if len(smp) == 0:
+            return labels
+
+        # count how often each parcel occurs in the vicinity of each sample
+        n_lab = len(self.labels)
+        pairs, counts = np.unique(smp * n_lab + self._atlas_idx[nodes],
+                                  return_counts=True)
+        smp, labs = pairs // n_lab, self.labels[pairs % n_lab]
+
+        # drop parcels that don't match hemisphere / structure of samples. as
+        # in `_assign_sample`, the parcels that remain are weighted equally
+        if self.atlas_info is not None:
+            if codes is not None:
+                codes = (codes[0][smp], codes[1][smp])
+            keep = self._check_codes(labs, codes) != 0
+            smp, labs = smp[keep], labs[keep]
+            counts = np.ones(len(smp), dtype=int)
+
+        # assign the most frequent parcel (if there is one) to each sample
+        top = np.zeros(len(coords), dtype=int)
+        np.maximum.at(top, smp, counts)
+        is_top = counts == top[smp]
+        n_top = np.bincount(smp[is_top], minlength=len(coords))
+        single = is_top & (n_top[smp] == 1)
+        labels[smp[single]] = labs[single]
+
+        # otherwise, break ties with the closest centroid (`labs` have already
+        # been checked against `self.atlas_info`, so no need to do it again)
+        ties = np.flatnonzero(n_top > 1)
+        bounds = np.searchsorted(smp, np.c_[ties, ties + 1])
+        for n, (start, stop) in zip(ties, bounds):
+            labels[n] = self._assign_sample(labs[start:stop], coords[n])
+
+        return labels
+
+    def _assign_sample(self, possible, coords, sample_info=None):
+        """
+        Determines which parcel a sample belongs to amongst `possible` labels
 
         Parameters
         ----------
         possible : list-of-int
-            Potential labels for `sample`
-        sample_info : pandas.DataFrame
-            A single row of an `annotation` file
+            Potential labels for sample
+        coords : (3,) array_like
+            XYZ coordinates of sample
+        sample_info : pandas.DataFrame, optional
+            A single row of an `annotation` file. If provided (and
+            `self.atlas_info` is not None), `possible` labels are required to
+            match the hemisphere / structure of the sample. Default: None
 
         Returns
         -------
         label : int
-            Chosen label of `sample`
+            Chosen label of sample
         """
 
         labels, counts = np.unique(possible, return_counts=True)
 
         # if atlas_info and sample_info are provided, drop potential labels who
         # don't match hemisphere or structural class defined in `sample_info`
-        if self.atlas_info is not None:
-            possible = _check_label(labels, sample, self.atlas_info)
+        if self.atlas_info is not None and sample_info is not None:
+            possible = self._check_codes(labels,
+                                         self._encode_samples(sample_info))
             labels, counts = np.unique(possible[possible.nonzero()],
                                        return_counts=True)
 
@@ -384,9 +626,8 @@ class AtlasTree:
 
         # if two or more parcels tied for neighboring frequency, use ROI
         # with closest centroid to `coords`
-        coords = sample[['mni_x', 'mni_y', 'mni_z']]
-        centroids = np.row_stack([self.centroids[lab] for lab in labels])
-        return labels[closest_centroid(coords, centroids)]
+        centroids = self._centroid_arr[np.searchsorted(self.labels, labels)]
+        return labels[closest_centroid(coords, centroids)[0]]
 
     def match_closest_centroids(self, annotation, return_dist=False):
         """
@@ -421,18 +662,19 @@ class AtlasTree:
         missing_info = any(col not in samples.columns
                            for col in ('structure', 'hemisphere'))
         if self.atlas_info is None or missing_info:
-            centroids = np.r_[list(self.centroids.values())]
-            match, distances = closest_centroid(samples[cols], centroids,
+            match, distances = closest_centroid(samples[cols],
+                                                self._centroid_arr,
                                                 return_dist=True)
             labels = np.asarray(list(self.centroids.keys()))[match]
         else:
             labels = np.full(len(samples), -1, dtype=int)
             distances = np.full(len(samples), np.inf)
+            hemis = np.asarray(self.atlas_info['hemisphere'])
+            structs = np.asarray(self.atlas_info['structure'])
             gb = samples.groupby(['structure', 'hemisphere'])
             for (struct, hemi), idx in gb.groups.items():
-                same = self.atlas_info.query(
-                    f'hemisphere == "{hemi}" & structure == "{struct}"'
-                ).index
+                same = self.atlas_info.index[np.logical_and(hemis == hemi,
+                                                            structs == struct)]
                 if len(same) == 0:
                     continue
                 centroids = np.r_[[self.centroids[lab] for lab in same]]
@@ -481,7 +723,7 @@ class AtlasTree:
         missing_info = any(col not in samples.columns
                            for col in ('structure', 'hemisphere'))
         # assign samples to nearest node (i.e., vertex / voxel)
-        dist, idx = self.tree.query(samples[cols], k=1)
+        dist, idx = self.tree.query(samples[cols], k=1, workers=self.workers)
 
         # now get distance between `label` nodes and assigned sample nodes
         idxs, = np.where(self.atlas == label)
@@ -492,7 +734,8 @@ class AtlasTree:
 
         # check if matched samples and nodes are compatible
         if self.atlas_info is not None:
-            labels = _check_label(self.atlas[idx], samples, self.atlas_info)
+            labels = self._check_codes(self.atlas[idx],
+                                       self._encode_samples(samples))
             dist[:, labels == 0] = np.inf
             # check if specified label is compatible w/nodes of matched samples
             if not missing_info:
@@ -509,51 +752,45 @@ class AtlasTree:
         return samples
 
 
-def _check_label(label, sample_info, atlas_info):
+def _morton_order(coords, cell_size=1):
     """
-    Checks that `label` defined by `sample_info` is coherent with `atlas_info`
-
-    Non-matching labels are re-assigned a value of 0
+    Returns indices that sort `coords` along a z-order (Morton) curve
 
     Parameters
     ----------
-    label : int or array_like
-        Tenative label(s) for sample(s) described by `sample_info`
-    sample_info : pandas.Series or pandas.DataFrame
-        Row(s) of an `annotation` file, corresponding to the given `label`
-    atlas_info : pandas.DataFrame
-        Dataframe containing information about the atlas of interest. Must have
-        at least columns ['id', 'hemisphere', 'structure'] containing
-        information mapping atlas IDs to hemisphere and broad structural class
+    coords : (N, 3) array_like
+        Coordinates to be sorted
+    cell_size : float, optional
+        Size of the grid cells into which `coords` are binned before sorting;
+        coordinates in the same cell are kept in their original order.
+        Default: 1
 
     Returns
     -------
-    label : np.ndarray
-        New label(s) for sample(s)
+    order : (N,) np.ndarray
+        Indices that sort `coords`
     """
 
-    cols = ['hemisphere', 'structure']
-    label = np.atleast_1d(label)
+    coords = np.atleast_2d(np.asarray(coords, dtype=float))
+    if len(coords) == 0:
+        return np.zeros(0, dtype=int)
 
-    if len(sample_info) != len(label):
-        sample_info = pd.concat([sample_info] * len(label))
+    # bin coordinates into a grid, keeping 21 bits per dimension so that the
+    # interleaved code fits in 63 bits
+    cells = np.floor((coords - coords.min(axis=0)) / cell_size)
+    cells = np.clip(cells, 0, (1 << 21) - 1).astype(np.uint64)
 
-    try:
-        ai = atlas_info.loc[label, cols]
-        drop = np.zeros_like(label, dtype=bool)
-        # only compare structure for bilateral ROIs
-        mask = np.asarray(ai['hemisphere'] == "B")
-        drop[mask] = (np.asarray(atlas_info.loc[ai[mask].index, 'structure'])
-                      != np.asarray(sample_info.loc[mask, 'structure']))
-        # but compare hemisphere + structure for L/R ROIs
-        mask = np.logical_not(mask)
-        drop[mask] = np.any(np.asarray(atlas_info.loc[ai[mask].index, cols])
-                            != np.asarray(sample_info.loc[mask, cols]), axis=1)
-        label[drop] = 0
-    except KeyError:
-        pass
+    # interleave the bits of the three cell indices
+    code = np.zeros(len(coords), dtype=np.uint64)
+    for dim in range(coords.shape[1]):
+        bits = cells[:, dim]
+        for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                            (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                            (2, 0x1249249249249249)):
+            bits = (bits | (bits << np.uint64(shift))) & np.uint64(mask)
+        code |= bits << np.uint64(dim)
 
-    return label
+    return np.argsort(code, kind='stable')
 
 
 def get_centroids(data, coordinates, labels=None):
@@ -581,9 +818,24 @@ def get_centroids(data, coordinates, labels=None):
     if labels is None:
         labels = np.trim_zeros(np.unique(data))
 
-    centroids = np.zeros((len(labels), coordinates.shape[-1]))
-    for n, lab in enumerate(labels):
-        centroids[n] = coordinates[data == lab].mean(axis=0)
+    if len(labels) == 0:
+        return dict()
+
+    # find which of `labels` each point belongs to (if any) in a single pass
+    order = np.argsort(labels)
+    idx = np.searchsorted(labels, data, sorter=order)
+    idx = order[np.clip(idx, 0, len(labels) - 1)]
+    valid = np.asarray(labels)[idx] == data
+    idx, coordinates = idx[valid], coordinates[valid]
+
+    # sum coordinates of all points w/each label and divide by point counts
+    counts = np.bincount(idx, minlength=len(labels))
+    centroids = np.column_stack([
+        np.bincount(idx, weights=coords, minlength=len(labels))
+        for coords in coordinates.T
+    ])
+    with np.errstate(invalid='ignore'):
+        centroids /= counts[:, None]
 
     return dict(zip(labels, centroids))
 
@@ -610,11 +862,19 @@ def closest_centroid(coords, centroids, return_dist=False):
         if `return_dist=True`
     """
 
-    coords, centroids = np.atleast_2d(coords), np.atleast_2d(centroids)
-    distances = distance_matrix(coords, centroids)
-    closest = distances.argmin(axis=1)
+    coords = np.atleast_2d(np.asarray(coords, dtype=float))
+    centroids = np.atleast_2d(np.asarray(centroids, dtype=float))
+
+    # squared distances as ||a||^2 + ||b||^2 - 2ab (i.e., a single GEMM); no
+    # need to take the square root for the argmin
+    sqdist = (np.sum(coords ** 2, axis=1)[:, None] - 2 * (coords @ centroids.T)
+              + np.sum(centroids ** 2, axis=1)[None, :])
+    closest = sqdist.argmin(axis=1)
 
     if return_dist:
-        return closest, distances[range(len(closest)), closest]
+        # compute distances to the closest centroids directly (rather than
+        # from `sqdist`) to avoid any loss of precision
+        distances = np.linalg.norm(coords - centroids[closest], axis=1)
+        return closest, distances
 
     return closest
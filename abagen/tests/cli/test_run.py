@@ -5,12 +5,37 @@ Tests for abagen.cli module
 
 import os
 from pkg_resources import resource_filename
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
 import pytest
 
 from abagen import __version__ as version
 from abagen.cli import run
 
 
+def test_run_import_light():
+    # building the CLI parser (e.g., for `--help`) should not drag in the
+    # scientific stack
+    heavy = ('nibabel', 'numpy', 'pandas', 'scipy')
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          'from abagen.cli import run; run.get_parser()'],
+                         check=True, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    imported = {line.split('|')[-1].strip().split('.')[0]
+                for line in out.stderr.splitlines()
+                if line.startswith('import time:')}
+    assert not imported.intersection(heavy)
+
+    # the hard-coded method names must match those actually available
+    from abagen.correct import NORMALIZATION_METHODS
+    from abagen.probes_ import SELECTION_METHODS
+    assert sorted(run.NORMALIZATION_METHODS) == sorted(NORMALIZATION_METHODS)
+    assert sorted(run.SELECTION_METHODS) == sorted(SELECTION_METHODS)
+
+
 def test_run_get_parser(capsys, atlas, datadir):
     parser = run.get_parser()
 
@@ -23,6 +48,11 @@ def test_run_get_parser(capsys, atlas, datadir):
     args = parser.parse_args([atlas['image']])
     assert os.path.normcase(args.atlas) == os.path.normcase(atlas['image'])
 
+    # output paths are made absolute (but needn't exist)
+    args = parser.parse_args(['--output-file', '~/test.csv', atlas['image']])
+    assert args.output_file == os.path.join(os.path.expanduser('~'),
+                                            'test.csv')
+
     # some data directories/files need to exist!
     with pytest.raises(SystemExit):
         parser.parse_args(['notanatlas.nii.gz'])
@@ -71,6 +101,13 @@ def test_run_get_parser(capsys, atlas, datadir):
     ])
 
 
+def test_run_main_version(capsys):
+    with pytest.raises(SystemExit) as err:
+        run.main(['--version'])
+    assert err.value.code == 0
+    assert 'abagen {}'.format(version) == capsys.readouterr().out.strip()
+
+
 def test_run_main(capsys, atlas, datadir):
     outputfile = os.path.join(datadir, 'abagen_expression.csv')
 
@@ -108,6 +145,22 @@ def test_run_main(capsys, atlas, datadir):
         assert stdout == data
 
 
+@pytest.mark.parametrize('n_proc', [1, 2, -1])
+def test_run_save_donors(tmp_path, n_proc):
+    expression = {
+        donor: pd.DataFrame(np.random.rand(5, 3), columns=['A', 'B', 'C'],
+                            index=pd.Series(range(1, 6), name='label'))
+        for donor in ('12876', '15496', '14380')
+    }
+    fnames = run._save_donors(expression, str(tmp_path), 'expression',
+                              n_proc=n_proc)
+    assert sorted(fnames) == sorted(expression)
+    for donor, df in expression.items():
+        assert fnames[donor] == str(tmp_path / f'expression_{donor}.csv')
+        out = pd.read_csv(fnames[donor], index_col=0)
+        pd.testing.assert_frame_equal(out, df)
+
+
 def test_exec_run_fail():
     executable = resource_filename('abagen', 'cli/run.py')
 
@@ -10,7 +10,7 @@ import pandas as pd
 import pytest
 import scipy.stats as sstats
 
-from abagen import allen, correct, io
+from abagen import allen, correct, io, utils
 from abagen.utils import flatten_dict
 
 
@@ -233,6 +233,59 @@ def test_resid_dist(dv, independent, expected):
                        eval(expected))
 
 
+def test_resid_dist_groups(dv):
+    # residualizing groups separately should match doing it one-by-one
+    dv = np.r_[dv, dv[::-1] * 2]
+    iv = np.r_[np.ones(5), np.arange(5)]
+    groups = np.repeat([0, 1], 5)
+    out = correct._resid_dist(dv, iv, groups=groups)
+    for grp in (0, 1):
+        assert np.allclose(out[groups == grp],
+                           correct._resid_dist(dv[groups == grp],
+                                               iv[groups == grp]))
+    assert np.allclose(out, np.r_[dv[:5] - dv[:5].mean(), np.zeros(5)])
+
+
+def test_resid_dist_numba(monkeypatch):
+    rs = np.random.RandomState(1234)
+    dv, iv = rs.rand(100), rs.rand(100)
+    groups = rs.choice(3, size=100)
+
+    # compiled kernel is only used for very large inputs
+    assert correct._RESID_NUMBA_MIN == 2_000_000
+    calls = []
+    monkeypatch.setattr(correct, '_resid_dist_numba',
+                        lambda *args: calls.append(args))
+    correct._resid_dist(dv, iv, groups=groups)
+    assert not calls
+    monkeypatch.setattr(correct, '_RESID_NUMBA_MIN', len(dv))
+    correct._resid_dist(dv, iv, groups=groups)
+    assert len(calls) == 1
+    monkeypatch.undo()
+
+    # compare against pure numpy implementation
+    pytest.importorskip('numba')
+    expected = correct._resid_dist(dv, iv, groups=groups)
+    assert np.allclose(correct._resid_dist_numba(dv, iv, groups), expected)
+
+
+def test_pairwise_corr():
+    pytest.importorskip('numba')
+    rs = np.random.RandomState(1234)
+    data = [rs.rand(10, 20), rs.rand(8, 20), rs.rand(9, 20)]
+    regions = [np.arange(10), np.arange(2, 10), np.arange(1, 10)]
+    data[0][4, 3] = np.nan  # NaNs in shared regions propagate
+
+    out = correct._pairwise_corr(data, regions)
+    assert out.shape == (20, 3)
+    for n, (s1, s2) in enumerate(itertools.combinations(range(3), 2)):
+        _, idx1, idx2 = np.intersect1d(regions[s1], regions[s2],
+                                       return_indices=True)
+        expected = utils.efficient_corr(data[s1][idx1], data[s2][idx2])
+        assert np.allclose(out[:, n], expected, equal_nan=True)
+    assert np.isnan(out[3, :2]).all() and not np.isnan(out[3, 2])
+
+
 @pytest.mark.parametrize("thr, per, rank, stab",
                          list(itertools.product(np.arange(0, 1, 0.1),
                                                 [True, False],
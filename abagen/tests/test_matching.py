@@ -11,7 +11,7 @@ import pytest
 from abagen import images, matching, transforms
 
 
-def test_check_label():
+def test_check_codes():
     sample_info = pd.DataFrame(dict(
         hemisphere=['R', 'R', 'L', 'L'],
         structure=['cortex', 'cortex', 'cortex', 'subcortex/brainstem']
@@ -19,17 +19,32 @@ def test_check_label():
     atlas_info = pd.DataFrame(dict(
         hemisphere=['R', 'L', 'L', 'B'],
         structure=['cortex', 'cortex', 'cortex', 'subcortex/brainstem']
-    ), index=pd.Series([1, 2, 3, 4], name='label'))
-
-    labels, expected = [1, 2, 3, 4], [1, 0, 3, 4]
-    out = matching._check_label(labels, sample_info, atlas_info)
-    assert np.allclose(out, expected)
-
-    col = ['hemisphere']
-    out = matching._check_label(labels, sample_info, atlas_info[col])
-    assert np.allclose(out, labels)
-    out = matching._check_label(labels, sample_info[col], atlas_info)
-    assert np.allclose(out, labels)
+    ), index=pd.Series([1, 2, 3, 4], name='id'))
+    tree = matching.AtlasTree([1, 2, 3, 4], np.random.rand(4, 3),
+                              atlas_info=atlas_info)
+
+    # only structure is compared for bilateral ROIs
+    labels = np.array([1, 2, 3, 4])
+    codes = tree._encode_samples(sample_info)
+    assert np.allclose(tree._check_codes(labels, codes), [1, 0, 3, 4])
+    # single sample is broadcast against all labels
+    codes = tree._encode_samples(sample_info.iloc[[0]])
+    assert np.allclose(tree._check_codes(labels, codes), [1, 0, 0, 0])
+    # no information on samples means no checks
+    assert tree._encode_samples(sample_info[['hemisphere']]) is None
+    assert np.allclose(tree._check_codes(labels, None), labels)
+    # labels not in the atlas are always dropped
+    codes = tree._encode_samples(sample_info.iloc[[0]])
+    assert np.allclose(tree._check_codes([1, 5], codes), [1, 0])
+
+    # negative / very large labels don't need to be densely indexed
+    atlas_info.index = pd.Series([-1, 2, 3, 165372282], name='id')
+    tree = matching.AtlasTree([-1, 2, 3, 165372282], np.random.rand(4, 3),
+                              atlas_info=atlas_info)
+    codes = tree._encode_samples(sample_info)
+    assert len(tree._label_codes) == 4
+    assert np.allclose(tree._check_codes(atlas_info.index, codes),
+                       [-1, 0, 3, 165372282])
 
 
 def test_get_centroids():
@@ -52,6 +67,12 @@ def test_get_centroids():
     centroids = matching.get_centroids(data, coords, labels=[1])
     assert len(centroids) == 1 and np.allclose(centroids[1], expected[1])
 
+    # order of provided labels is retained
+    centroids = matching.get_centroids(data, coords, labels=[2, 1])
+    assert list(centroids) == [2, 1]
+    for k, v in centroids.items():
+        assert np.allclose(expected[k], v)
+
 
 def test_closest_centroids():
     centroids = np.array([[1, 1, 1], [4, 4, 4]])
@@ -63,6 +84,16 @@ def test_closest_centroids():
     assert np.allclose(out, 0)
 
 
+def test_morton_order():
+    # unit cube is visited in z-order: x varies fastest, then y, then z
+    coords = np.array([[1, 1, 1], [0, 0, 0], [0, 0, 1], [1, 0, 0], [0, 1, 0]])
+    assert np.all(matching._morton_order(coords) == [1, 3, 4, 2, 0])
+    # coordinates that share a cell keep their original order
+    out = matching._morton_order(coords, cell_size=2)
+    assert np.all(out == np.arange(len(coords)))
+    assert len(matching._morton_order(np.zeros((0, 3)))) == 0
+
+
 def test_AtlasTree(atlas, surface):
     # basic test data
     data = np.array([1, 1, 1, 2, 2, 2])
@@ -81,12 +112,27 @@ def test_AtlasTree(atlas, surface):
     assert str(tree) == 'AtlasTree[n_rois=2, n_vertex=6]'
     assert not tree.volumetric
     assert tree.atlas_info is None
+    assert tree.workers == -1
+    assert matching.AtlasTree(data, coords, workers=1).workers == 1
     assert np.all(tree.atlas == data)
     assert np.all(tree.coords == coords)
     assert np.all(tree.labels == [1, 2])
     assert len(tree.centroids) == 2 and list(tree.centroids.keys()) == [1, 2]
+    assert np.allclose(tree._centroid_arr, [tree.centroids[1],
+                                            tree.centroids[2]])
     tree.atlas_info = atlas_info
     pd.testing.assert_frame_equal(tree.atlas_info, atlas_info)
+    info, codes = tree.atlas_info, tree._label_codes
+    tree.atlas_info = info
+    assert tree.atlas_info is info and tree._label_codes is codes
+    tree.coords = coords
+    assert np.all(tree.coords == coords)
+    dist = np.sqrt(3) * 3
+    assert np.allclose(tree._get_centroid_dist([2, 1]), [dist])
+    assert tree._centroid_dist is None  # only cached for all parcels
+    assert np.allclose(tree._get_centroid_dist([1, 2]), [dist])
+    assert tree._centroid_dist is not None
+    assert len(tree._get_centroid_dist([2])) == 0
 
     # check sample matching
     labels = tree.label_samples([[0, 0, 0], [3, 3, 3]])
@@ -94,6 +140,8 @@ def test_AtlasTree(atlas, surface):
 
     # check coordinate assignment AND outlier removal in same go
     tree.coords = coords[::-1]
+    assert np.allclose(tree._get_centroid_dist([1, 2]), [dist])
+    assert np.allclose(tree._centroid_arr, [[4, 4, 4], [1, 1, 1]])
     labels = tree.label_samples(np.row_stack((coords, [1000, 1000, 1000])))
     assert np.all(labels['label'] == [2, 2, 2, 1, 1, 1, 0])
 
@@ -128,6 +176,7 @@ def test_AtlasTree(atlas, surface):
     assert tree.volumetric
     assert tree.atlas_info is None
     assert np.all(tree.labels == np.arange(1, 84))
+    assert tree._atlas_idx.dtype == np.uint8
     assert len(tree.centroids) == 83
     tree.atlas_info = atlas['info']
     assert isinstance(tree.atlas_info, pd.DataFrame)
@@ -168,6 +217,79 @@ def test_AtlasTree(atlas, surface):
                            coords=np.random.rand(99, 3))
 
 
+def test_float_atlas():
+    # whole-number labels in a float atlas are preserved exactly
+    labels = np.array([1, 2049, 3001, 165372282], dtype=float)
+    coords = np.eye(4, 3) * 10
+    tree = matching.AtlasTree(labels, coords)
+    assert tree.atlas.dtype == labels.dtype
+    assert np.all(tree.atlas == labels.astype(int))
+    assert np.all(tree.labels == labels.astype(int))
+    out = tree.label_samples(coords, tolerance=0)
+    assert np.all(out['label'] == labels.astype(int))
+
+
+@pytest.fixture
+def random_tree():
+    # small surface-style tree + samples shared by the sample assignment tests
+    rs = np.random.RandomState(1234)
+    tree = matching.AtlasTree(rs.choice(4, size=500), rs.rand(500, 3) * 10)
+    samples = pd.DataFrame(rs.rand(50, 3) * 10,
+                           columns=['mni_x', 'mni_y', 'mni_z'])
+    samples['hemisphere'] = rs.choice(['L', 'R'], size=50)
+    samples['structure'] = 'cortex'
+    atlas_info = pd.DataFrame(dict(
+        hemisphere=['L', 'R', 'B'], structure='cortex'
+    ), index=pd.Series([1, 2, 3], name='id'))
+    return tree, samples, atlas_info
+
+
+def test_assign_samples(random_tree):
+    tree, samples, atlas_info = random_tree
+
+    # vectorized assignment should match assigning samples one at a time
+    xyz = samples.iloc[:, :3].to_numpy()
+    matches = tree.tree.query_ball_point(xyz, 1)
+    smp = np.repeat(np.arange(len(xyz)), [len(m) for m in matches])
+    nodes = np.concatenate(matches).astype(int)
+    for info in (None, atlas_info):
+        tree.atlas_info = info
+        expected = np.zeros(len(samples))
+        for n, match in enumerate(matches):
+            if len(match) > 0:
+                expected[n] = tree._assign_sample(tree.atlas[match], xyz[n],
+                                                  samples.iloc[[n]])
+        codes = None if info is None else tree._encode_samples(samples)
+        assert np.all(tree._assign_samples(smp, nodes, xyz, codes)
+                      == expected)
+
+    # ties are broken with the correct centroids, even for negative labels
+    tree = matching.AtlasTree(np.array([-1, -1, -1, 5, 5, 5]),
+                              np.repeat(np.arange(6)[:, None], 3, axis=1))
+    assert tree._assign_sample([-1, 5], [0, 0, 0]) == -1
+    assert tree._assign_sample([-1, 5], [5, 5, 5]) == 5
+
+
+def test_match_volume(random_tree):
+    tree, samples, atlas_info = random_tree
+    xyz = samples.iloc[:, :3].to_numpy()
+
+    # staged queries should match expanding the search radius one at a time
+    for info in (None, atlas_info):
+        tree.atlas_info = info
+        codes = None if info is None else tree._encode_samples(samples)
+        expected = np.zeros(len(samples))
+        for tol in range(3):
+            left = np.flatnonzero(expected == 0)
+            matches = tree.tree.query_ball_point(xyz[left], tol)
+            smp = np.repeat(left, [len(m) for m in matches])
+            nodes = np.concatenate(matches).astype(int)
+            expected[left] = tree._assign_samples(smp, nodes, xyz,
+                                                  codes)[left]
+        assert np.any(expected != 0)
+        assert np.all(tree._match_volume(samples, 2.5) == expected)
+
+
 def test_nonint_voxels(atlas):
     coord = [[-56.8, -50.6, 8.8]]
     affine = np.zeros((4, 4))